@@ -0,0 +1,205 @@
+'''
+Local SQLite stand-in for the Wind tables used by monitor.py.
+Build it once with "python localdb.py [path] [startDate] [endDate]", then run monitor.py with
+MFL_DB_BACKEND=sqlite (and MFL_SQLITE_PATH if the file is not at the default place).
+The data is synthetic but keeps the shapes and sizes of the real tables.
+'''
+import os
+import pathlib
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localdb.sqlite")
+
+SCHEMA = \
+    '''
+    CREATE TABLE IF NOT EXISTS asharecalendar (
+        TRADE_DAYS TEXT,
+        S_INFO_EXCHMARKET TEXT
+    );
+    CREATE INDEX IF NOT EXISTS asharecalendar_days ON asharecalendar (TRADE_DAYS);
+
+    CREATE TABLE IF NOT EXISTS AShareMarginTrade (
+        S_INFO_WINDCODE TEXT,
+        TRADE_DT TEXT,
+        S_REFIN_SB_EOD_VOL REAL,
+        S_REFIN_SL_EOP_VOL REAL,
+        S_REFIN_SL_EOP_BAL REAL,
+        S_REFIN_REPAY_VOL REAL
+    );
+    CREATE INDEX IF NOT EXISTS AShareMarginTrade_dt ON AShareMarginTrade (TRADE_DT, S_INFO_WINDCODE);
+
+    CREATE TABLE IF NOT EXISTS AIndexHS300Weight (
+        S_INFO_WINDCODE TEXT,
+        S_CON_WINDCODE TEXT,
+        TRADE_DT TEXT,
+        I_WEIGHT REAL
+    );
+    CREATE INDEX IF NOT EXISTS AIndexHS300Weight_dt ON AIndexHS300Weight (TRADE_DT);
+
+    CREATE TABLE IF NOT EXISTS aindexcsi500weight (
+        S_INFO_WINDCODE TEXT,
+        S_CON_WINDCODE TEXT,
+        TRADE_DT TEXT,
+        TOT_SHR REAL,
+        FREE_SHR_RATIO REAL,
+        SHR_CALCULATION REAL,
+        CLOSEVALUE REAL,
+        OPEN_ADJUSTED REAL,
+        WEIGHT REAL
+    );
+    CREATE INDEX IF NOT EXISTS aindexcsi500weight_dt ON aindexcsi500weight (TRADE_DT);
+
+    CREATE TABLE IF NOT EXISTS AIndexMembers (
+        S_INFO_WINDCODE TEXT,
+        S_CON_WINDCODE TEXT,
+        S_CON_INDATE TEXT,
+        S_CON_OUTDATE TEXT,
+        CUR_SIGN TEXT
+    );
+    CREATE INDEX IF NOT EXISTS AIndexMembers_index ON AIndexMembers (S_INFO_WINDCODE);
+
+    CREATE TABLE IF NOT EXISTS AShareSWIndustriesClass (
+        S_INFO_WINDCODE TEXT,
+        SW_IND_CODE TEXT,
+        ENTRY_DT TEXT,
+        REMOVE_DT TEXT,
+        CUR_SIGN TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS AShareIndustriesCode (
+        INDUSTRIESCODE TEXT,
+        INDUSTRIESNAME TEXT,
+        LEVELNUM TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS AShareDescription (
+        S_INFO_WINDCODE TEXT PRIMARY KEY,
+        S_INFO_CODE TEXT,
+        S_INFO_NAME TEXT,
+        S_INFO_LISTDATE TEXT
+    );
+    '''
+
+
+def connect(path=DEFAULT_PATH) -> sqlite3.Connection:
+    '''
+    Open an existing local database built by buildLocalDatabase
+    :param path: str, file path of the SQLite database
+    :return: sqlite3.Connection
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError("No local database at " + path + ", build it with \"python localdb.py\" first!")
+    # mode=rw never creates a file, so a wrong path cannot turn into an empty database
+    return sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=rw", uri=True, check_same_thread=False)
+
+
+SW_INDUSTRIES = ["农林牧渔", "采掘", "化工", "钢铁", "有色金属", "电子", "家用电器", "食品饮料", "纺织服装", "轻工制造",
+                 "医药生物", "公用事业", "交通运输", "房地产", "商业贸易", "休闲服务", "综合", "建筑材料", "建筑装饰",
+                 "电气设备", "国防军工", "计算机", "传媒", "通信", "银行", "非银金融", "汽车", "机械设备"]
+
+
+def makeStockCodes() -> pd.DataFrame:
+    '''
+    A synthetic A-share universe with the same board mix as the real market.
+    :return: pd.DataFrame, columns ["S_INFO_WINDCODE", "S_INFO_CODE", "S_INFO_NAME", "S_INFO_LISTDATE"]
+    '''
+    boards = [("600", 1000, "SH", "20000101"), ("601", 200, "SH", "20080101"), ("603", 400, "SH", "20150101"),
+              ("000", 450, "SZ", "20000101"), ("001", 10, "SZ", "20180101"), ("002", 950, "SZ", "20080101"),
+              ("300", 800, "SZ", "20100101"), ("688", 70, "SH", "20190722")]
+    rows = []
+    for prefix, count, exchange, listDate in boards:
+        for i in range(1, count + 1):
+            code = prefix + str(i).zfill(3)
+            rows.append([code + "." + exchange, code, "样本" + code, listDate])
+    return pd.DataFrame(rows, columns=["S_INFO_WINDCODE", "S_INFO_CODE", "S_INFO_NAME", "S_INFO_LISTDATE"])
+
+
+def buildLocalDatabase(path=DEFAULT_PATH, startDate="20190101", endDate="20191231", seed=0):
+    '''
+    Fill the local database with synthetic data.
+    The calendar always covers 2012-2019 because a TradingCalendar built from scratch starts at CALENDAR_START,
+    20120101, margin and index weight data cover startDate to endDate.
+    :param path: str, file path of the SQLite database, replaced if it exists
+    :param startDate: str, "yyyymmdd"
+    :param endDate: str, "yyyymmdd"
+    :param seed: int, random seed
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.RandomState(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+
+    calendar = [d.strftime("%Y%m%d") for d in pd.bdate_range("20120101", "20191231")]
+    pd.DataFrame({"TRADE_DAYS": calendar, "S_INFO_EXCHMARKET": "SSE"}).to_sql(
+        "asharecalendar", conn, if_exists="append", index=False)
+
+    stocks = makeStockCodes()
+    stocks.to_sql("AShareDescription", conn, if_exists="append", index=False)
+
+    days = [d for d in calendar if startDate <= d <= endDate]
+    codes = stocks.S_INFO_WINDCODE.values
+    listDates = stocks.S_INFO_LISTDATE.values
+    # roughly 1600 stocks are eligible for refinancing, each one joins the list on a random day
+    eligible = rng.rand(len(codes)) < 0.45
+    joinDay = rng.randint(-len(days), len(days), len(codes))
+    endVol = rng.lognormal(13, 1.5, len(codes))
+    price = rng.lognormal(2.5, 0.7, len(codes))
+    # index members are the first 300 / next 500 codes of this order, some of them are swapped every half year
+    order = rng.permutation(len(codes))
+
+    for k, day in enumerate(days):
+        if k > 0 and k % 120 == 0:
+            inIndex, outIndex = rng.choice(800, 40, replace=False), rng.choice(np.arange(800, len(codes)), 40, replace=False)
+            order[inIndex], order[outIndex] = order[outIndex], order[inIndex].copy()
+        hs300, csi500 = codes[order[:300]], codes[order[300:800]]
+        active = eligible & (joinDay <= k) & (listDates <= day)
+        sell = rng.lognormal(10, 2, len(codes)) * (rng.rand(len(codes)) < 0.3)
+        repay = np.minimum(endVol, rng.lognormal(10, 2, len(codes)) * (rng.rand(len(codes)) < 0.3))
+        endVol = endVol + sell - repay
+        price = price * np.exp(rng.normal(0, 0.02, len(codes)))
+        pd.DataFrame({"S_INFO_WINDCODE": codes[active], "TRADE_DT": day, "S_REFIN_SB_EOD_VOL": sell[active],
+                      "S_REFIN_SL_EOP_VOL": endVol[active], "S_REFIN_SL_EOP_BAL": (endVol * price)[active],
+                      "S_REFIN_REPAY_VOL": repay[active]}).to_sql(
+            "AShareMarginTrade", conn, if_exists="append", index=False)
+        pd.DataFrame({"S_INFO_WINDCODE": "000300.SH", "S_CON_WINDCODE": hs300, "TRADE_DT": day,
+                      "I_WEIGHT": 100 / len(hs300)}).to_sql(
+            "AIndexHS300Weight", conn, if_exists="append", index=False)
+        pd.DataFrame({"S_INFO_WINDCODE": "000905.SH", "S_CON_WINDCODE": csi500, "TRADE_DT": day,
+                      "TOT_SHR": 1e9, "FREE_SHR_RATIO": 0.5, "SHR_CALCULATION": 5e8, "CLOSEVALUE": 10.0,
+                      "OPEN_ADJUSTED": 10.0, "WEIGHT": 100 / len(csi500)}).to_sql(
+            "aindexcsi500weight", conn, if_exists="append", index=False)
+    # Shenwan level 1 industries, code "61xx000000" at LEVELNUM 2, stocks are classified at level 3
+    industryCodes = ["61" + str(i + 1).zfill(2) + "000000" for i in range(len(SW_INDUSTRIES))]
+    pd.DataFrame({"INDUSTRIESCODE": industryCodes, "INDUSTRIESNAME": SW_INDUSTRIES, "LEVELNUM": "2"}).to_sql(
+        "AShareIndustriesCode", conn, if_exists="append", index=False)
+    stockIndustry = rng.randint(0, len(SW_INDUSTRIES), len(codes))
+    pd.DataFrame({"S_INFO_WINDCODE": codes, "SW_IND_CODE": [industryCodes[i][:4] + "010100" for i in stockIndustry],
+                  "ENTRY_DT": listDates, "REMOVE_DT": None, "CUR_SIGN": "1"}).to_sql(
+        "AShareSWIndustriesClass", conn, if_exists="append", index=False)
+
+    # interval-style members of the other indices: SSE50 from the SH names of HS300, ChiNext from the 300 board,
+    # CSI1000 from the codes after CSI500; a tenth of them leave on a random day and are replaced
+    initial = codes[rng.permutation(len(codes))]
+    pools = {"000016.SH": [c for c in codes[:300] if c.endswith(".SH")], "399006.SZ": [c for c in initial if c.startswith("300")],
+             "000852.SH": list(codes[800:])}
+    sizes = {"000016.SH": 50, "399006.SZ": 100, "000852.SH": 1000}
+    for indexCode, pool in pools.items():
+        size = min(sizes[indexCode], len(pool) // 2)
+        members, spare = pool[:size], pool[size:]
+        outDates = np.where(rng.rand(size) < 0.1, rng.choice(days, size), None)
+        rows = [[indexCode, code, "20120101", out] for code, out in zip(members, outDates)]
+        rows += [[indexCode, spare[i], out, None] for i, out in enumerate(d for d in outDates if d is not None)]
+        pd.DataFrame([row + ["1" if row[3] is None else "0"] for row in rows],
+                     columns=["S_INFO_WINDCODE", "S_CON_WINDCODE", "S_CON_INDATE", "S_CON_OUTDATE", "CUR_SIGN"]).to_sql(
+            "AIndexMembers", conn, if_exists="append", index=False)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    buildLocalDatabase(*sys.argv[1:])
@@ -4,62 +4,1378 @@ import pandas as pd
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import QFont
 import sys
+import os
+import time
+import atexit
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import localdb
+try:
+    import fcntl  # inter-process locks of the local cache, msvcrt on Windows
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    import pyarrow  # parquet engine for the local cache
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    CACHE_FORMAT = "pickle"
+
+
+QUERY_WORKERS = 6  # threads used to run the independent queries of calMarginLoanParam
+# index key -> Wind weight table holding its daily constituents
+INDEX_WEIGHT_TABLES = {"HS": "AIndexHS300Weight", "CSI": "aindexcsi500weight"}
+# index key -> Wind index code, for indices whose membership comes from AIndexMembers
+INDEX_MEMBER_CODES = {"CSI1000": "000852.SH", "SSE50": "000016.SH", "ChiNext": "399006.SZ"}
+# index key -> display name
+INDEX_NAMES = {"HS": "沪深300", "CSI": "中证500", "CSI1000": "中证1000", "SSE50": "上证50", "ChiNext": "创业板指"}
+# group buckets of calMarginLoanParam, a stock takes the first bucket whose index it belongs to
+GROUP_BUCKETS = [("中证500", ["CSI"]), ("沪深300", ["HS"])]
+GROUP_DEFAULT = "其他股票"
+GROUP_ORDER = ["沪深300", "中证500", "其他股票"]  # row order of the group table in the App
+# boards of the A-share market, a code takes the first board whose exchange and code prefix it matches
+BOARDS = [("科创板", "SH", ["688"]), ("沪市主板", "SH", ["60"]), ("深市主板", "SZ", ["000", "001"]),
+          ("中小板", "SZ", ["002"]), ("创业板", "SZ", ["300"])]
+BOARD_DEFAULT = "其他"
+MAIN_BOARDS = ["沪市主板", "深市主板"]  # boards summed into the "main" total of calMarginLoanParam
+# ranking views of calMarginLoanParam, all cut from one ranking by end balance, see rankViews.
+# "change", "changeBottom", "HS300" and "CSI500" are the tables of the App, which shows 10 rows of each
+RANKING_VIEWS = {
+    "change": {"n": 10},
+    "changeBottom": {"n": 10, "bottom": True},
+    "HS300": {"column": "group", "value": "沪深300", "n": 10},
+    "CSI500": {"column": "group", "value": "中证500", "n": 10},
+    "SSE50": {"index": "SSE50", "n": 10},
+    "ChiNext": {"index": "ChiNext", "n": 10},
+    "industryTop": {"column": "industry", "n": 5},
+    "boardTop": {"column": "board", "n": 10},
+}
+# indices precomputed into the membership bitmask of IndexGrouping, bit i stands for GROUP_INDICES[i]
+GROUP_INDICES = ["HS", "CSI", "CSI1000", "SSE50", "ChiNext"]
+# IN lists of bind variables are padded to one of these lengths, so the statement cache sees a few SQL texts only.
+# Oracle accepts at most 1000 expressions in an IN list.
+IN_LIST_SIZES = [16, 64, 256, 1000]
+CALENDAR_START = "20120101"  # first day of the calendar when it is built from scratch
+CACHE_DIR = os.environ.get("MFL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+# directory of the per-date debug snapshots of calMarginLoanParam, unset to turn the snapshots off
+DEBUG_DIR = os.environ.get("MFL_DEBUG_DIR")
+
+
+sqlLogger = logging.getLogger("monitor.sql")
+
+
+class QueryStats(object):
+    '''
+    Timing and volume of every database call in this process.
+    Each call is also written to the "monitor.sql" logger as one JSON line,
+    enable it with e.g. logging.basicConfig(level=logging.INFO).
+    '''
+
+    records = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, tag: str, connect: float, execute: float, fetch: float, rows: int, nbytes: int):
+        '''
+        :param tag: str, name of the helper that issued the query
+        :param connect: float, seconds spent acquiring the session
+        :param execute: float, seconds spent in cursor.execute
+        :param fetch: float, seconds spent fetching rows and building the DataFrame
+        :param rows: int, number of rows returned
+        :param nbytes: int, approximate size of the result in memory
+        '''
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "tag": tag, "connect": round(connect, 6),
+                  "execute": round(execute, 6), "fetch": round(fetch, 6), "rows": int(rows), "bytes": int(nbytes)}
+        with cls._lock:
+            cls.records.append(record)
+        sqlLogger.info(json.dumps(record, ensure_ascii=False))
+
+    @classmethod
+    def summary(cls) -> pd.DataFrame:
+        '''
+        :return: pd.DataFrame, call count and totals per tag, slowest tag first
+        '''
+        with cls._lock:
+            records = pd.DataFrame(cls.records, columns=["time", "tag", "connect", "execute", "fetch", "rows", "bytes"])
+        stats = records.groupby("tag")[["connect", "execute", "fetch", "rows", "bytes"]].sum()
+        stats.insert(0, "calls", records.groupby("tag").size())
+        stats["total"] = stats.connect + stats.execute + stats.fetch
+        return stats.sort_values(by="total", ascending=False)
+
+    @classmethod
+    def dump(cls, path=None):
+        '''
+        Print the summary, and also save it as csv if path is given
+        '''
+        stats = cls.summary()
+        print(stats)
+        if path is not None:
+            stats.to_csv(path)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.records = []
+
+
+class DatabaseUnavailableError(Exception):
+    '''
+    The database could not be reached within the connect budget and there is no cached result to fall back on.
+    '''
+    pass
 
 
 class OracleSql(object):
     '''
-    Query data from database
+    Query data from database.
+    All instances share one process-wide cx_Oracle session pool, so entering
+    "with OracleSql()" borrows a pooled session instead of opening a new connection.
+    With backend "sqlite" (environment variable MFL_DB_BACKEND=sqlite) the same tables are read from a
+    local SQLite file built by localdb.py instead of the Wind database.
+    Connecting is bounded by connect_timeout and connect_retries. With fallback_cache switched on, query()
+    returns the last result of the same query from the local cache when the database is down or times out.
     '''
 
-    def __init__(self, pt=False):
+    backend = os.environ.get("MFL_DB_BACKEND", "oracle")  # "oracle" or "sqlite"
+    sqlite_path = os.environ.get("MFL_SQLITE_PATH", localdb.DEFAULT_PATH)
+
+    # Session pool settings, change them with OracleSql.configurePool() before the first query.
+    pool_min = 1
+    pool_max = 6  # enough for the concurrent queries of calMarginLoanParam
+    pool_increment = 1
+    acquire_timeout = 10  # seconds to wait for a free session before giving up
+    ping_interval = 60  # seconds a session may sit idle before it is pinged on acquire
+    fetch_arraysize = 10000  # default rows per round trip and per chunk in query_iter()
+    statement_cache_size = 40  # parsed statements kept per session, bind variables make them reusable
+
+    # Latency budget: a dead database costs at most about
+    # (connect_retries + 1) * connect_timeout + retry_backoff * (2 ** connect_retries - 1) seconds per process,
+    # after that every OracleSql stays offline for offline_retry_after seconds and serves cached results.
+    connect_timeout = 5  # seconds for the TCP connect and the login
+    query_timeout = 60  # seconds a single round trip may take
+    connect_retries = 2
+    retry_backoff = 1.0  # seconds before the first retry, doubled for every further retry
+    offline_retry_after = 60
+    fallback_cache = os.environ.get("MFL_FALLBACK_CACHE") == "1"  # keep the last results for the offline fallback
+    fallback_max_entries = 100  # oldest results are dropped beyond this
+    # errors meaning the database is unreachable or too slow, any other error is raised
+    unavailable_errors = ("ORA-01013", "ORA-03113", "ORA-03114", "ORA-03135", "ORA-12170", "ORA-12541", "ORA-12543",
+                          "DPI-1010", "DPI-1067", "DPI-1080", "database is locked", "unable to open database")
+
+    _offline_until = 0.0
+
+    _pool = None
+    _pool_self_pings = False
+    _pool_lock = threading.Lock()
+
+    def __init__(self, pt=False, tag=None):
         '''
         Initialize database
+        :param tag: str, label of the queries in QueryStats, defaults to the name of the calling function
         '''
         self.host, self.oracle_port = '18.210.64.72', '1521'
         self.db, self.current_schema = 'tdb', 'wind'
         self.user, self.pwd = 'reader', 'reader'
         self.pt = pt
+        self.tag = tag if tag is not None else sys._getframe(1).f_code.co_name
+        self.connect_time = 0.0
 
     def __enter__(self):
         '''
-        Connect to database
+        Acquire a session from the pool
         :return: self
         '''
-        self.conn = self.__connect_to_oracle()
+        start = time.perf_counter()
+        try:
+            self.conn = self.__connect_to_oracle()
+        except DatabaseUnavailableError as e:
+            # callers that can degrade say so themselves, with the cached data they use instead
+            print('Database unavailable! ' + str(e))
+            self.conn = None
+        self.connect_time = time.perf_counter() - start
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        if self.conn is not None:
+            if self.backend == "sqlite":
+                self.conn.close()
+            else:
+                OracleSql._pool.release(self.conn)
+            self.conn = None
+
+    @classmethod
+    def configurePool(cls, minSessions=None, maxSessions=None, increment=None, acquireTimeout=None,
+                      pingInterval=None):
+        '''
+        Change the session pool settings. An existing pool is closed and rebuilt lazily with the new settings.
+        :param minSessions: int, sessions opened when the pool is created
+        :param maxSessions: int, upper bound of concurrent sessions
+        :param increment: int, sessions opened each time the pool grows
+        :param acquireTimeout: float, seconds to wait for a free session
+        :param pingInterval: float, idle seconds after which a session is health-checked on acquire
+        '''
+        if minSessions is not None:
+            cls.pool_min = minSessions
+        if maxSessions is not None:
+            cls.pool_max = maxSessions
+        if increment is not None:
+            cls.pool_increment = increment
+        if acquireTimeout is not None:
+            cls.acquire_timeout = acquireTimeout
+        if pingInterval is not None:
+            cls.ping_interval = pingInterval
+        cls.closePool()
+
+    @classmethod
+    def closePool(cls):
+        '''
+        Close the shared session pool, if any
+        '''
+        with cls._pool_lock:
+            if cls._pool is not None:
+                try:
+                    cls._pool.close(force=True)
+                except Exception:
+                    pass
+                cls._pool = None
+
+    def __get_pool(self):
+        '''
+        Create the shared session pool on first use, retrying with exponential backoff.
+        Only one thread creates the pool, the others wait for its outcome instead of running their own retries.
+        :return: cx_Oracle.SessionPool
+        '''
+        with OracleSql._pool_lock:
+            if OracleSql._pool is not None:
+                return OracleSql._pool
+            dsn = "(DESCRIPTION=(CONNECT_TIMEOUT={0})(TRANSPORT_CONNECT_TIMEOUT={0})" \
+                  "(ADDRESS=(PROTOCOL=TCP)(HOST={1})(PORT={2}))(CONNECT_DATA=(SERVICE_NAME={3})))".format(
+                      self.connect_timeout, self.host, self.oracle_port, self.db)
+            for attempt in range(self.connect_retries + 1):
+                # a waiter that got the lock after a failed attempt gives up at once
+                self.__check_online()
+                try:
+                    pool = cx_Oracle.SessionPool(self.user, self.pwd, dsn, min=self.pool_min, max=self.pool_max,
+                                                 increment=self.pool_increment, threaded=True,
+                                                 getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT,
+                                                 encoding="UTF-8", nencoding="UTF-8")
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < self.connect_retries:
+                        time.sleep(self.retry_backoff * 2 ** attempt)
+            else:
+                self.__go_offline(error)
+            pool.wait_timeout = int(self.acquire_timeout * 1000)
+            try:
+                pool.ping_interval = int(self.ping_interval)
+                OracleSql._pool_self_pings = True
+            except AttributeError:
+                # cx_Oracle < 8.2 has no built-in health check, ping on every acquire instead
+                OracleSql._pool_self_pings = False
+            OracleSql._pool = pool
+            return pool
+
+    def __check_online(self):
+        '''
+        Raise at once while the database is marked offline
+        '''
+        if time.time() < OracleSql._offline_until:
+            raise DatabaseUnavailableError("Skipped connecting, the last attempt failed less than "
+                                           + str(self.offline_retry_after) + " seconds ago.")
+
+    def __go_offline(self, error):
+        '''
+        Mark the database offline for offline_retry_after seconds and raise
+        '''
+        print('Failed on connecting to Oracle database!')
+        OracleSql._offline_until = time.time() + self.offline_retry_after
+        raise DatabaseUnavailableError(str(error))
 
     def __connect_to_oracle(self):
         '''
-        Connect to database
+        Acquire a healthy session from the shared pool, retrying with exponential backoff.
+        Idle sessions are pinged by the pool itself; a dead session is dropped and replaced.
+        The offline mark is checked before every attempt, so once one thread has used up the connect budget
+        the others stop retrying.
         :return: connection
         '''
-        dsn = self.host + ':' + self.oracle_port + '/' + self.db
+        if self.backend == "sqlite":
+            return localdb.connect(self.sqlite_path)
+        pool = self.__get_pool()
+        for attempt in range(self.connect_retries + 1):
+            self.__check_online()
+            try:
+                connection = pool.acquire()
+                if not OracleSql._pool_self_pings:
+                    try:
+                        connection.ping()
+                    except cx_Oracle.Error:
+                        pool.drop(connection)
+                        connection = pool.acquire()
+                connection.current_schema = self.current_schema
+                connection.stmtcachesize = self.statement_cache_size
+                try:
+                    connection.call_timeout = int(self.query_timeout * 1000)
+                except AttributeError:
+                    pass  # needs cx_Oracle >= 7 and Oracle client >= 18
+                if self.pt is True:
+                    print('Connected to Oracle database successful!')
+                return connection
+            except Exception as e:
+                error = e
+                if attempt < self.connect_retries:
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+        self.__go_offline(error)
+
+    def __fallback_key(self, sql: str, params) -> str:
+        '''
+        :return: str, cache key identifying the query text and its bind values
+        '''
+        text = sql + json.dumps(params or {}, sort_keys=True, default=str)
+        return self.tag + "_" + hashlib.md5(text.encode("utf-8")).hexdigest()
+
+    def __fallback(self, sql: str, params, error, fallback: bool) -> pd.DataFrame:
+        '''
+        Return the cached result of the query, or raise if it was never cached
+        '''
+        if not (fallback and self.fallback_cache):
+            raise DatabaseUnavailableError("Database unavailable for " + self.tag + ": " + str(error))
+        df = readLocalCache("fallback", self.__fallback_key(sql, params))
+        if df is None:
+            raise DatabaseUnavailableError("No cached result for " + self.tag + ": " + str(error))
+        print("Using cached result for " + self.tag + ": " + str(error))
+        return df
+
+    def __keep_fallback(self, sql: str, params, df: pd.DataFrame):
+        '''
+        Save the result for the offline fallback and drop the oldest results beyond fallback_max_entries
+        '''
+        writeLocalCache("fallback", self.__fallback_key(sql, params), df)
+        directory = os.path.join(CACHE_DIR, "fallback")
         try:
-            connection = cx_Oracle.connect(self.user, self.pwd, dsn, encoding="UTF-8", nencoding="UTF-8")
-            connection.current_schema = self.current_schema
-            if self.pt is True:
-                print('Connected to Oracle database successful!')
-        except Exception:
-            print('Failed on connecting to Oracle database!')
-            connection = None
-        return connection
+            paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+            paths = sorted(paths, key=os.path.getmtime)
+            for path in paths[:max(len(paths) - self.fallback_max_entries, 0)]:
+                os.remove(path)
+        except OSError:
+            pass
 
-    def query(self, sql: str) -> pd.DataFrame:
+    def query(self, sql: str, params=None, fallback=True) -> pd.DataFrame:
         '''
         Query data
+        :param sql: str, may contain bind variables such as ":tradeDate"
+        :param params: dict, values of the bind variables
+        :param fallback: bool, whether the result takes part in the offline fallback,
+                         pass False for data the caller caches itself
         '''
-        return pd.read_sql(sql, self.conn)
+        if self.conn is None:
+            return self.__fallback(sql, params, "not connected", fallback)
+        try:
+            cursor = self.conn.cursor()
+            try:
+                cursor.arraysize = self.fetch_arraysize
+                start = time.perf_counter()
+                cursor.execute(sql, params or {})
+                executed = time.perf_counter()
+                columns = [d[0] for d in cursor.description]
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns, coerce_float=True)
+                fetched = time.perf_counter()
+            finally:
+                cursor.close()
+        except (cx_Oracle.DatabaseError, sqlite3.DatabaseError) as e:
+            if not any(code in str(e) for code in self.unavailable_errors):
+                raise
+            return self.__fallback(sql, params, e, fallback)
+        self.__record(executed - start, fetched - executed, len(df), df.memory_usage(deep=True).sum())
+        if fallback and self.fallback_cache:
+            self.__keep_fallback(sql, params, df)
+        return df
 
-    def execute(self, sql: str):
+    def query_iter(self, sql: str, params=None, chunk_rows=None, prefetch_rows=None):
         '''
-        Execute SQL scripts, including inserting and updating
+        Query data chunk by chunk, so that large results are streamed with bounded memory
+        :param sql: str, may contain bind variables such as ":tradeDate"
+        :param params: dict, values of the bind variables
+        :param chunk_rows: int, rows per yielded chunk, also used as the cursor arraysize
+        :param prefetch_rows: int, rows fetched together with the execute round trip
+        :return: generator of pd.DataFrame
+        '''
+        if self.conn is None:
+            raise DatabaseUnavailableError("Streaming queries have no cached fallback: " + self.tag)
+        if chunk_rows is None:
+            chunk_rows = self.fetch_arraysize
+        cursor = self.conn.cursor()
+        executeTime, fetchTime, rows, nbytes = 0.0, 0.0, 0, 0
+        try:
+            cursor.arraysize = chunk_rows
+            if prefetch_rows is not None and self.backend != "sqlite":
+                cursor.prefetchrows = prefetch_rows
+            start = time.perf_counter()
+            cursor.execute(sql, params or {})
+            executeTime = time.perf_counter() - start
+            columns = [d[0] for d in cursor.description]
+            while True:
+                start = time.perf_counter()
+                chunk = cursor.fetchmany(chunk_rows)
+                if not chunk:
+                    fetchTime += time.perf_counter() - start
+                    break
+                df = pd.DataFrame.from_records(chunk, columns=columns, coerce_float=True)
+                fetchTime += time.perf_counter() - start
+                rows += len(df)
+                nbytes += df.memory_usage(deep=True).sum()
+                yield df
+        finally:
+            cursor.close()
+            self.__record(executeTime, fetchTime, rows, nbytes)
 
+    def execute(self, sql: str, params=None):
+        '''
+        Execute SQL scripts, including inserting and updating
+        :param sql: str, may contain bind variables such as ":tradeDate"
+        :param params: dict, values of the bind variables
         '''
-        self.conn.cursor().execute(sql)
+        if self.conn is None:
+            raise DatabaseUnavailableError("Cannot execute without a connection: " + self.tag)
+        cursor = self.conn.cursor()
+        start = time.perf_counter()
+        cursor.execute(sql, params or {})
         self.conn.commit()
+        self.__record(time.perf_counter() - start, 0.0, max(cursor.rowcount, 0), 0)
+
+    def __record(self, execute: float, fetch: float, rows: int, nbytes: int):
+        '''
+        Add one call to QueryStats. The session acquire time is charged to the first call of this session only.
+        '''
+        QueryStats.record(self.tag, self.connect_time, execute, fetch, rows, nbytes)
+        self.connect_time = 0.0
+
+
+atexit.register(OracleSql.closePool)
+
+
+class TradingCalendar(object):
+    '''
+    SSE trading days with O(log n) range lookups and O(1) day lookups.
+    The calendar is persisted in the local cache and shared by the whole process through load().
+    It remembers which date window it has queried and grows on demand: a date outside that window only
+    queries the missing head or tail from asharecalendar.
+    '''
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, days, start=None, end=None):
+        '''
+        :param days: list-like of "yyyymmdd" trading days
+        :param start: str, "yyyymmdd", first date of the queried window, defaults to the first day
+        :param end: str, "yyyymmdd", last date of the queried window, defaults to the last day
+        '''
+        self.days = sorted(set(days))
+        self.position = {day: i for i, day in enumerate(self.days)}
+        self.start = start if start is not None else self.days[0]
+        self.end = end if end is not None else self.days[-1]
+        self._extend_lock = threading.RLock()
+
+    @classmethod
+    def load(cls, startDate=CALENDAR_START):
+        '''
+        Get the shared calendar, reading it from the local cache or the database on first use
+        :param startDate: str, "yyyymmdd", first day queried when there is no cached calendar
+        :return: TradingCalendar
+        '''
+        with cls._lock:
+            if cls._instance is None:
+                cached = readLocalCache("calendar", "SSE")
+                window = readLocalCache("calendar", "SSE_window")
+                if cached is not None and window is not None:
+                    cls._instance = cls(list(cached.trade_days), window.start[0], window.end[0])
+                else:
+                    # an empty window ending the day before startDate, so the first extension queries from startDate
+                    cls._instance = cls([], startDate, shiftDate(startDate, -1))
+                    cls._instance.extendTo(time.strftime("%Y%m%d"))
+            return cls._instance
+
+    def extendTo(self, date: str):
+        '''
+        Make sure date is inside the queried window, querying only the missing part of the calendar
+        :param date: str, "yyyymmdd"
+        '''
+        with self._extend_lock:
+            if self.start <= date <= self.end:
+                return
+            if date < self.start:
+                queryStart, queryEnd = date, shiftDate(self.start, -1)
+            else:
+                queryStart = shiftDate(self.end, 1)
+                # fetch up to the end of the year in one go, the exchange publishes the calendar a year ahead
+                queryEnd = max(date, date[:4] + "1231")
+            try:
+                newDays = getTradingDays(queryStart, queryEnd)
+            except DatabaseUnavailableError as e:
+                if len(self.days) == 0:
+                    raise
+                print("Using the cached calendar up to " + self.end + ": " + str(e))
+                return
+            self.days = sorted(set(self.days).union(newDays))
+            self.position = {day: i for i, day in enumerate(self.days)}
+            today = time.strftime("%Y%m%d")
+            # days up to today are final, later ones only as far as the exchange has published them
+            knownEnd = max(min(queryEnd, today), max(newDays) if newDays else "00000000")
+            self.start = min(self.start, queryStart)
+            self.end = max(self.end, knownEnd) if queryEnd > self.end else self.end
+            writeLocalCache("calendar", "SSE", pd.DataFrame({"trade_days": self.days}))
+            writeLocalCache("calendar", "SSE_window", pd.DataFrame({"start": [self.start], "end": [self.end]}))
+
+    def __len__(self):
+        return len(self.days)
+
+    def __contains__(self, date):
+        self.extendTo(date)
+        return date in self.position
+
+    def index(self, date: str) -> int:
+        '''
+        :param date: str, "yyyymmdd", must be a trading day
+        :return: int, position of date in the calendar
+        '''
+        self.extendTo(date)
+        if date not in self.position:
+            raise ValueError(date + " is not a trading day in the calendar")
+        return self.position[date]
+
+    def resolve(self, date: str) -> str:
+        '''
+        :param date: str, "yyyymmdd", any calendar day
+        :return: str, date itself if it is a trading day, otherwise the nearest trading day before it
+        '''
+        self.extendTo(date)
+        if date in self.position:
+            return date
+        i = bisect.bisect_right(self.days, date) - 1
+        if i < 0:
+            self.extendTo(shiftDate(date, -30))
+            i = bisect.bisect_right(self.days, date) - 1
+            if i < 0:
+                raise IndexError("No trading day before " + date)
+        return self.days[i]
+
+    def offset(self, date: str, k: int) -> str:
+        '''
+        :param date: str, "yyyymmdd", must be a trading day
+        :param k: int, number of trading days to move, negative for earlier days
+        :return: str, the trading day k days away from date
+        '''
+        i = self.index(date) + k
+        if i < 0:
+            # about 245 trading days a year, look back far enough in one query
+            self.extendTo(shiftDate(self.start, -(-i // 200 + 1) * 366))
+        elif i >= len(self.days):
+            self.extendTo(shiftDate(self.end, ((i - len(self.days)) // 200 + 1) * 366))
+        i = self.index(date) + k
+        if i < 0 or i >= len(self.days):
+            raise IndexError("Offset " + str(k) + " from " + date + " is outside the calendar")
+        return self.days[i]
+
+    def prev(self, date: str, k=1) -> str:
+        return self.offset(date, -k)
+
+    def next(self, date: str, k=1) -> str:
+        return self.offset(date, k)
+
+    def range(self, startDate: str, endDate: str) -> list:
+        '''
+        :return: list, trading days between startDate and endDate, both included
+        '''
+        self.extendTo(startDate)
+        self.extendTo(endDate)
+        return self.days[bisect.bisect_left(self.days, startDate):bisect.bisect_right(self.days, endDate)]
+
+
+class IndexMembership(object):
+    '''
+    Constituent history of one index kept as (code, in_date, out_date) intervals, in_date included and
+    out_date excluded. It is built once from the Wind weight table, persisted in the local cache and
+    extended incrementally with the snapshots published after the last loaded one.
+    Indices of INDEX_MEMBER_CODES already come as intervals from AIndexMembers and are simply reloaded
+    when a date after the last load is asked for.
+    '''
+
+    OPEN = "99999999"  # out_date of constituents that are still in the index
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, index: str, intervals: pd.DataFrame, start: str, end: str):
+        '''
+        :param index: str, key of INDEX_WEIGHT_TABLES or INDEX_MEMBER_CODES
+        :param intervals: pd.DataFrame, columns ["code", "in_date", "out_date"]
+        :param start: str, "yyyymmdd", first date of the loaded history
+        :param end: str, "yyyymmdd", last snapshot date loaded
+        '''
+        self.index = index
+        self.intervals = intervals.reset_index(drop=True)
+        self.start, self.end = start, end
+        self._update_lock = threading.RLock()
+
+    @classmethod
+    def load(cls, index: str, startDate=CALENDAR_START):
+        '''
+        Get the shared membership of an index, from the local cache or built from the weight table on first use
+        :param index: str, key of INDEX_WEIGHT_TABLES or INDEX_MEMBER_CODES
+        :param startDate: str, "yyyymmdd", first day of the history when it is built from scratch
+        :return: IndexMembership
+        '''
+        if index not in INDEX_WEIGHT_TABLES and index not in INDEX_MEMBER_CODES:
+            raise ValueError("Parameter Error!")
+        with cls._lock:
+            if index not in cls._instances:
+                intervals = readLocalCache("membership", index)
+                window = readLocalCache("membership", index + "_window")
+                if intervals is not None and window is not None:
+                    cls._instances[index] = cls(index, intervals, window.start[0], window.end[0])
+                else:
+                    membership = cls(index, pd.DataFrame(columns=["code", "in_date", "out_date"]), startDate,
+                                     shiftDate(startDate, -1))
+                    membership.update(time.strftime("%Y%m%d"))
+                    cls._instances[index] = membership
+            return cls._instances[index]
+
+    @staticmethod
+    def buildIntervals(snapshots: pd.DataFrame, dates) -> pd.DataFrame:
+        '''
+        Turn daily constituent snapshots into membership intervals.
+        A code stays in one interval as long as it is found in consecutive snapshots.
+        :param snapshots: pd.DataFrame, columns ["code", "trade_dt"]
+        :param dates: sorted list of all snapshot dates
+        :return: pd.DataFrame, columns ["code", "in_date", "out_date"]
+        '''
+        if len(snapshots) == 0:
+            return pd.DataFrame(columns=["code", "in_date", "out_date"])
+        dates = np.asarray(dates)
+        k = pd.Series(np.arange(len(dates)), index=dates)[snapshots.trade_dt.values].values
+        rows = pd.DataFrame({"code": snapshots.code.values, "k": k}).sort_values(["code", "k"])
+        newRun = (rows.code != rows.code.shift()) | (rows.k != rows.k.shift() + 1)
+        runs = rows.groupby(newRun.cumsum().values)
+        code, firstK, lastK = runs.code.first().values, runs.k.first().values, runs.k.last().values
+        nextDates = np.append(dates, IndexMembership.OPEN)
+        return pd.DataFrame({"code": code, "in_date": dates[firstK], "out_date": nextDates[lastK + 1]})
+
+    def update(self, date: str):
+        '''
+        Load the snapshots published after the last loaded one, up to date
+        While the database is unavailable the loaded intervals are kept, so dates after them see the latest snapshot.
+        :param date: str, "yyyymmdd"
+        '''
+        with self._update_lock:
+            loaded = (self.intervals, self.start, self.end)
+            try:
+                if self.index in INDEX_MEMBER_CODES:
+                    self.__update_from_members(date)
+                else:
+                    self.__update_from_weights(date)
+            except DatabaseUnavailableError as e:
+                self.intervals, self.start, self.end = loaded
+                if self.end < self.start:
+                    raise
+                print("Using the " + self.index + " membership loaded up to " + self.end + ": " + str(e))
+
+    def __save(self):
+        writeLocalCache("membership", self.index, self.intervals)
+        writeLocalCache("membership", self.index + "_window", pd.DataFrame({"start": [self.start], "end": [self.end]}))
+
+    def __update_from_members(self, date: str):
+        '''
+        Reload the intervals of the index from AIndexMembers if date is after the last load
+        '''
+        with self._update_lock:
+            if date <= self.end:
+                return
+            sql = \
+                '''
+                SELECT
+                ''' + '''
+                    S_CON_WINDCODE, S_CON_INDATE, S_CON_OUTDATE
+                FROM
+                    AIndexMembers
+                WHERE
+                    S_INFO_WINDCODE = :indexCode
+                '''
+            with OracleSql(tag="IndexMembership") as oracle:
+                intervals = oracle.query(sql, {"indexCode": INDEX_MEMBER_CODES[self.index]}, fallback=False)
+            intervals.columns = ["code", "in_date", "out_date"]
+            intervals["out_date"] = intervals.out_date.fillna(self.OPEN)
+            self.intervals = intervals
+            self.start = min(self.start, intervals.in_date.min()) if len(intervals) > 0 else self.start
+            # the table is complete up to today, later dates see today's members
+            self.end = max(date, time.strftime("%Y%m%d"))
+            self.__save()
+
+    def __update_from_weights(self, date: str):
+        '''
+        Load the weight table snapshots published after the last loaded one, up to date
+        '''
+        with self._update_lock:
+            if date < self.start:
+                # history before the loaded window, rebuild from that date up to everything loaded so far
+                startDate, date = date, max(date, self.end)
+                self.intervals = pd.DataFrame(columns=["code", "in_date", "out_date"])
+                self.start, self.end = startDate, shiftDate(startDate, -1)
+            if date <= self.end:
+                return
+            sql = \
+                '''
+                SELECT
+                ''' + '''
+                    S_CON_WINDCODE, TRADE_DT
+                FROM
+                    {}
+                WHERE
+                    TRADE_DT > :lastDate
+                    AND TRADE_DT <= :tradeDate
+                '''.format(INDEX_WEIGHT_TABLES[self.index])
+            with OracleSql(tag="IndexMembership") as oracle:
+                chunks = list(oracle.query_iter(sql, {"lastDate": self.end, "tradeDate": date}))
+            if len(chunks) == 0:
+                return
+            snapshots = pd.concat(chunks, ignore_index=True)
+            snapshots.columns = ["code", "trade_dt"]
+            newDates = sorted(snapshots.trade_dt.unique())
+            isOpen = self.intervals.out_date == self.OPEN
+            opened = self.intervals[isOpen]
+            if len(opened) > 0:
+                # constituents of the last loaded snapshot continue their intervals into the new snapshots
+                snapshots = pd.concat([pd.DataFrame({"code": opened.code.values, "trade_dt": self.end}), snapshots],
+                                      ignore_index=True)
+                newDates = [self.end] + newDates
+            newIntervals = self.buildIntervals(snapshots, newDates)
+            inDates = dict(zip(opened.code, opened.in_date))
+            continued = (newIntervals.in_date == self.end) & newIntervals.code.isin(inDates)
+            newIntervals.loc[continued, "in_date"] = newIntervals.code[continued].map(inDates)
+            self.intervals = pd.concat([self.intervals[~isOpen], newIntervals], ignore_index=True)
+            self.end = newDates[-1]
+            self.__save()
+
+    def members(self, date: str) -> list:
+        '''
+        :param date: str, "yyyymmdd"
+        :return: list, constituent codes on date
+        '''
+        self.update(date)
+        intervals = self.intervals
+        return list(intervals.code[(intervals.in_date <= date) & (date < intervals.out_date)])
+
+    def membersBetween(self, startDate: str, endDate: str) -> list:
+        '''
+        :return: list, codes that were constituents on at least one day between startDate and endDate
+        '''
+        self.update(startDate)
+        self.update(endDate)
+        intervals = self.intervals
+        return list(intervals.code[(intervals.in_date <= endDate) & (startDate < intervals.out_date)].unique())
+
+    def isMember(self, codes, dates) -> np.ndarray:
+        '''
+        Vectorized membership test for a whole panel
+        :param codes: array-like of windcodes
+        :param dates: array-like of "yyyymmdd", same length as codes
+        :return: np.ndarray of bool
+        '''
+        dates = np.asarray(dates, dtype=object)
+        if len(dates) > 0:
+            self.update(max(dates))
+            self.update(min(dates))
+        panel = pd.DataFrame({"code": np.asarray(codes), "date": dates, "row": np.arange(len(dates))})
+        matched = panel.merge(self.intervals, on="code")
+        hit = matched.row[(matched.in_date <= matched.date) & (matched.date < matched.out_date)].values
+        result = np.zeros(len(dates), dtype=bool)
+        result[hit] = True
+        return result
+
+
+def classifyBoards(codes) -> np.ndarray:
+    '''
+    :param codes: list-like of windcodes
+    :return: np.ndarray of int8, position in BOARDS of the board of every code, len(BOARDS) for none of them
+    '''
+    codes = pd.Series(np.asarray(codes, dtype=object), dtype=object)
+    exchanges = codes.str[-2:]
+    conditions = [(exchanges == exchange) & np.logical_or.reduce([codes.str.startswith(prefix) for prefix in prefixes])
+                  for board, exchange, prefixes in BOARDS]
+    return np.select(conditions, np.arange(len(BOARDS)), default=len(BOARDS)).astype(np.int8)
+
+
+class CacheFileLock(object):
+    '''
+    Exclusive lock shared by all processes using the same local cache, e.g. the live monitor and a backfill.
+    Use it as "with CacheFileLock(name):".
+    '''
+
+    def __init__(self, name: str):
+        '''
+        :param name: str, name of the lock file in CACHE_DIR
+        '''
+        self.path = os.path.join(CACHE_DIR, name + ".lock")
+        self.file = None
+        self.locked = False  # False when the lock file cannot be created, e.g. CACHE_DIR is not writable
+
+    def __enter__(self):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            self.file = open(self.path, "a+")
+        except OSError:
+            print("Failed on creating the cache lock " + self.path + "!")
+            return self
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 seconds, keep waiting
+        self.locked = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.locked:
+            return
+        self.locked = False
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+
+class SecurityMaster(object):
+    '''
+    Stable int32 surrogate keys ("sid") for windcodes. Ids are handed out in order of first sight, never reused,
+    and persisted in the local cache so that id-keyed caches stay valid between runs.
+    New sids are handed out under a lock shared with other processes, after merging the sids they handed out,
+    and only once the master is saved. When the master cannot be saved, sids are handed out in memory only and
+    sid-keyed partitions are no longer written by this process. Frames are keyed by sid internally and converted
+    back to windcodes only for display; cached partitions keep the windcodes too, see readSidCache.
+    '''
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, codes):
+        '''
+        :param codes: list of windcodes, position = sid
+        '''
+        self._codes = np.asarray(codes, dtype=object)
+        self._index = pd.Index(self._codes)
+        self._boards = np.zeros(0, dtype=np.int8)  # board of every sid as a position in BOARDS, filled lazily
+        self._assign_lock = threading.Lock()
+        self.persisted = True  # False once new sids could not be saved, they then live in this process only
+
+    @classmethod
+    def load(cls):
+        '''
+        Get the shared security master from the local cache, or start an empty one
+        :return: SecurityMaster
+        '''
+        with cls._lock:
+            if cls._instance is None:
+                cached = readLocalCache("master", "securities")
+                cls._instance = cls(list(cached.code) if cached is not None else [])
+            return cls._instance
+
+    def __len__(self):
+        return len(self._codes)
+
+    def ids(self, codes) -> np.ndarray:
+        '''
+        :param codes: list-like of windcodes
+        :return: np.ndarray of int32, unknown codes get new ids
+        '''
+        codes = np.asarray(codes, dtype=object)
+        ids = self._index.get_indexer(codes)
+        if (ids < 0).any():
+            with self._assign_lock:
+                if self.persisted:
+                    with CacheFileLock("master") as lock:
+                        ids = self.__assign(codes, lock.locked)
+                else:
+                    ids = self.__assign(codes, False)
+        return ids.astype(np.int32)
+
+    def __assign(self, codes: np.ndarray, locked: bool) -> np.ndarray:
+        '''
+        Hand out sids to the unknown codes, saving the master first while it can be saved
+        :param codes: np.ndarray of windcodes
+        :param locked: bool, whether the master lock is held
+        :return: np.ndarray, sid of every code
+        '''
+        if self.persisted and locked:
+            self.__merge(readLocalCache("master", "securities"))
+        ids = self._index.get_indexer(codes)
+        unknown = pd.unique(codes[ids < 0])
+        if len(unknown) > 0:
+            allCodes = np.concatenate([self._codes, unknown])
+            saved = locked and writeLocalCache("master", "securities", pd.DataFrame({"code": allCodes}))
+            if self.persisted and not saved:
+                print("Failed on saving the security master! New sids are kept in memory "
+                      "and sid-keyed partitions are not written any more.")
+                self.persisted = False
+            self._codes = allCodes
+            self._index = pd.Index(self._codes)
+            ids = self._index.get_indexer(codes)
+        return ids
+
+    def __merge(self, cached):
+        '''
+        Append the sids other processes have saved since this master was loaded
+        :param cached: pd.DataFrame, the saved master, or None
+        '''
+        if cached is None:
+            return
+        saved = np.asarray(cached.code, dtype=object)
+        if len(saved) < len(self._codes) or not (saved[:len(self._codes)] == self._codes).all():
+            print("The saved security master does not match the one in use, cached partitions are re-keyed on read!")
+        extra = saved[~pd.Index(saved).isin(self._index)]
+        if len(extra) > 0:
+            self._codes = np.concatenate([self._codes, extra])
+            self._index = pd.Index(self._codes)
+
+    def codes(self, ids) -> np.ndarray:
+        '''
+        :param ids: list-like of sid
+        :return: np.ndarray of windcodes
+        '''
+        return self._codes[np.asarray(ids, dtype=np.int64)]
+
+    def boards(self, ids) -> pd.Categorical:
+        '''
+        :param ids: list-like of sid
+        :return: pd.Categorical, board of every sid, categories are the boards of BOARDS followed by BOARD_DEFAULT
+        '''
+        boards = self._boards
+        if len(boards) < len(self._codes):
+            with self._assign_lock:
+                boards = self._boards
+                if len(boards) < len(self._codes):
+                    boards = np.concatenate([boards, classifyBoards(self._codes[len(boards):])])
+                    self._boards = boards
+        return pd.Categorical.from_codes(boards[np.asarray(ids, dtype=np.int64)],
+                                         [board for board, exchange, prefixes in BOARDS] + [BOARD_DEFAULT])
+
+    def shortCodeIds(self) -> pd.Series:
+        '''
+        :return: pd.Series, sid indexed by the 6 digit code, the first sid wins when two exchanges share digits
+        '''
+        shortCodes = pd.Series(np.arange(len(self._codes), dtype=np.int32), index=[code[:6] for code in self._codes])
+        return shortCodes[~shortCodes.index.duplicated()]
+
+
+class StockNames(object):
+    '''
+    Security name dimension from AShareDescription, loaded once per process and persisted in the local cache.
+    Names are stored as categoricals keyed by sid; codes that are not known yet are queried one batch at a time.
+    '''
+
+    MISSING_RECHECK_DAYS = 7  # codes not found in AShareDescription are queried again after this many days
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, names: pd.Series, missing=None):
+        '''
+        :param names: pd.Series, stock names indexed by sid
+        :param missing: pd.Series, "yyyymmdd" day each sid was last not found in AShareDescription, indexed by sid
+        '''
+        self.names = names.astype("category")
+        self.names.index.name = "sid"
+        # sids not found in AShareDescription, not queried again until MISSING_RECHECK_DAYS have passed
+        if missing is None:
+            missing = pd.Series([], index=pd.Index([], dtype=np.int32), dtype=object)
+        self.missing = missing
+        self.missing.index.name = "sid"
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        '''
+        Get the shared name dimension, from the local cache or the whole AShareDescription table on first use
+        :return: StockNames
+        '''
+        with cls._lock:
+            if cls._instance is None:
+                master = SecurityMaster.load()
+                cached = readSidCache("names_sid", "AShareDescription")
+                if cached is not None:
+                    missing = readSidCache("names_sid", "AShareDescription_missing")
+                    cls._instance = cls(cached.stockName, missing.checkDate if missing is not None else None)
+                else:
+                    names = getStockName().iloc[:, 0]
+                    instance = cls(pd.Series(names.values, index=master.ids(names.index)))
+                    instance.save()
+                    cls._instance = instance
+            return cls._instance
+
+    def save(self):
+        writeSidCache("names_sid", "AShareDescription", self.names.to_frame("stockName"))
+        writeSidCache("names_sid", "AShareDescription_missing", self.missing.to_frame("checkDate"))
+
+    def refresh(self, ids):
+        '''
+        Query the names of sids that are not known yet
+        :param ids: list-like of sid
+        '''
+        with self._refresh_lock:
+            ids = pd.unique(np.asarray(ids, dtype=np.int32))
+            recheck = shiftDate(time.strftime("%Y%m%d"), -self.MISSING_RECHECK_DAYS)
+            stillMissing = self.missing.index[self.missing.values > recheck]
+            unknown = ids[~pd.Index(ids).isin(self.names.index) & ~pd.Index(ids).isin(stillMissing)]
+            if len(unknown) == 0:
+                return
+            master = SecurityMaster.load()
+            unknownCodes = list(master.codes(unknown))
+            try:
+                found = self.__query(unknownCodes)
+            except DatabaseUnavailableError as e:
+                print("Names of " + str(len(unknownCodes)) + " stocks are unknown: " + str(e))
+                return
+            found = pd.concat(found, ignore_index=True).drop_duplicates()
+            foundIds = master.ids(found.iloc[:, 0])
+            notFound = unknown[~pd.Index(unknown).isin(foundIds)]
+            missing = self.missing[~self.missing.index.isin(unknown)]
+            self.missing = pd.concat([missing, pd.Series(time.strftime("%Y%m%d"), index=notFound, dtype=object)])
+            self.missing.index.name = "sid"
+            if len(found) > 0:
+                names = pd.concat([self.names.astype(object), pd.Series(found.iloc[:, 1].values, index=foundIds)])
+                self.names = names.astype("category")
+                self.names.index.name = "sid"
+            self.save()
+
+    @staticmethod
+    def __query(codes) -> list:
+        '''
+        :param codes: list of windcodes
+        :return: list of pd.DataFrame, columns S_INFO_WINDCODE and S_INFO_NAME
+        '''
+        found = []
+        for placeholders, params in inListBatches(codes):
+            sql = \
+                '''
+                SELECT
+                ''' + '''
+                S_INFO_WINDCODE, S_INFO_NAME
+                FROM
+                AShareDescription
+                WHERE
+                S_INFO_WINDCODE IN ({})
+                '''.format(placeholders)
+            with OracleSql(tag="StockNames") as oracle:
+                found.append(oracle.query(sql, params, fallback=False))
+        return found
+
+    def frame(self, ids=None) -> pd.DataFrame:
+        '''
+        :param ids: list-like of sid, None for all known securities
+        :return: pd.DataFrame, column "stockName" indexed by sid, securities without a name are left out
+        '''
+        if ids is None:
+            return self.names.to_frame("stockName")
+        self.refresh(ids)
+        names = self.names
+        return names[names.index.isin(ids)].to_frame("stockName")
+
+
+class StockIndustries(object):
+    '''
+    Shenwan level 1 industry of every stock, loaded once per process and persisted in the local cache.
+    Stocks missing from the mapping are queried one batch at a time on lookup. The whole mapping is reloaded
+    every REFRESH_DAYS days to pick up reclassifications; while the database is unavailable the persisted one is used.
+    '''
+
+    UNKNOWN = "未分类"
+    REFRESH_DAYS = 7  # days after which the whole mapping is read from the database again
+    MISSING_RECHECK_DAYS = 7  # unclassified stocks are queried again after this many days
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, industries: pd.Series, loadDate: str, missing=None):
+        '''
+        :param industries: pd.Series, industry names indexed by sid
+        :param loadDate: str, "yyyymmdd", day the whole mapping was read from the database
+        :param missing: pd.Series, "yyyymmdd" day each sid was last found unclassified, indexed by sid
+        '''
+        self.industries = industries.astype("category")
+        self.industries.index.name = "sid"
+        self.loadDate = loadDate
+        if missing is None:
+            missing = pd.Series([], index=pd.Index([], dtype=np.int32), dtype=object)
+        self.missing = missing
+        self.missing.index.name = "sid"
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        '''
+        Get the shared industry mapping, from the local cache, or from the database on first use
+        and once it is REFRESH_DAYS days old
+        :return: StockIndustries
+        '''
+        with cls._lock:
+            today = time.strftime("%Y%m%d")
+            if cls._instance is None:
+                cached = readSidCache("industries_sid", "SW")
+                if cached is not None and len(cached) > 0:
+                    missing = readSidCache("industries_sid", "SW_missing")
+                    cls._instance = cls(cached.industry, cached.loadDate.iloc[0],
+                                        missing.checkDate if missing is not None else None)
+            if cls._instance is None or cls._instance.loadDate <= shiftDate(today, -cls.REFRESH_DAYS):
+                try:
+                    industries = getStockIndustry()
+                except DatabaseUnavailableError as e:
+                    if cls._instance is None:
+                        raise
+                    print("Using the industry mapping of " + cls._instance.loadDate + ": " + str(e))
+                else:
+                    master = SecurityMaster.load()
+                    instance = cls(pd.Series(industries.values, index=master.ids(industries.index)), today)
+                    instance.save()
+                    cls._instance = instance
+            return cls._instance
+
+    def save(self):
+        mapping = pd.DataFrame({"industry": self.industries.values, "loadDate": self.loadDate},
+                               index=self.industries.index)
+        writeSidCache("industries_sid", "SW", mapping)
+        writeSidCache("industries_sid", "SW_missing", self.missing.to_frame("checkDate"))
+
+    def refresh(self, ids):
+        '''
+        Query the industries of sids that are not in the mapping yet.
+        They stay unknown while the database is unavailable.
+        :param ids: list-like of sid
+        '''
+        with self._refresh_lock:
+            ids = pd.unique(np.asarray(ids, dtype=np.int32))
+            recheck = shiftDate(time.strftime("%Y%m%d"), -self.MISSING_RECHECK_DAYS)
+            stillMissing = self.missing.index[self.missing.values > recheck]
+            unknown = ids[~pd.Index(ids).isin(self.industries.index) & ~pd.Index(ids).isin(stillMissing)]
+            if len(unknown) == 0:
+                return
+            master = SecurityMaster.load()
+            try:
+                found = getStockIndustry(master.codes(unknown))
+            except DatabaseUnavailableError as e:
+                print("Industries of " + str(len(unknown)) + " stocks are unknown: " + str(e))
+                return
+            foundIds = master.ids(found.index)
+            notFound = unknown[~pd.Index(unknown).isin(foundIds)]
+            missing = self.missing[~self.missing.index.isin(unknown)]
+            self.missing = pd.concat([missing, pd.Series(time.strftime("%Y%m%d"), index=notFound, dtype=object)])
+            self.missing.index.name = "sid"
+            if len(found) > 0:
+                industries = pd.concat([self.industries.astype(object), pd.Series(found.values, index=foundIds)])
+                self.industries = industries.astype("category")
+                self.industries.index.name = "sid"
+            self.save()
+
+    def lookup(self, ids) -> pd.Series:
+        '''
+        :param ids: list-like of sid
+        :return: pd.Series, categorical industry of each security, UNKNOWN for unclassified ones
+        '''
+        self.refresh(ids)
+        industries = self.industries.reindex(ids)
+        if industries.isnull().any():
+            industries = industries.cat.add_categories([self.UNKNOWN]).fillna(self.UNKNOWN)
+        return industries
+
+
+class IndexGrouping(object):
+    '''
+    Membership of several indices packed into one bitmask per code, bit i set when the code belongs to indices[i].
+    Group labels and per-index aggregates are computed from the bitmasks with vectorized bit operations.
+    '''
+
+    def __init__(self, indices=GROUP_INDICES):
+        '''
+        :param indices: list, keys of INDEX_WEIGHT_TABLES or INDEX_MEMBER_CODES, at most 64
+        '''
+        if len(indices) > 64:
+            raise ValueError("Parameter Error!")
+        self.indices = list(indices)
+        self.bits = {index: np.uint64(1) << np.uint64(i) for i, index in enumerate(self.indices)}
+
+    def memberSets(self, date: str) -> dict:
+        '''
+        :param date: str, "yyyymmdd"
+        :return: dict, index key -> np.ndarray of the constituents' sids on date
+        '''
+        master = SecurityMaster.load()
+        return {index: master.ids(IndexMembership.load(index).members(date)) for index in self.indices}
+
+    def bitmask(self, ids, memberSets: dict) -> np.ndarray:
+        '''
+        :param ids: list-like of sid
+        :param memberSets: dict, result of memberSets()
+        :return: np.ndarray of uint64, one bitmask per security
+        '''
+        ids = pd.Index(ids)
+        masks = np.zeros(len(ids), dtype=np.uint64)
+        for index in self.indices:
+            masks |= ids.isin(memberSets[index]).astype(np.uint64) * self.bits[index]
+        return masks
+
+    def mask(self, indices) -> np.uint64:
+        '''
+        :param indices: list-like of index keys
+        :return: np.uint64, bitmask with the bits of those indices set
+        '''
+        bits = np.uint64(0)
+        for index in indices:
+            bits |= self.bits[index]
+        return bits
+
+    def assign(self, masks: np.ndarray, buckets, default: str) -> pd.Categorical:
+        '''
+        Label every code with the first bucket whose indices it belongs to
+        :param masks: np.ndarray of uint64, result of bitmask()
+        :param buckets: list of (label, list of index keys), checked in order
+        :param default: str, label of codes in none of the buckets
+        :return: pd.Categorical, categories are the bucket labels followed by default
+        '''
+        conditions = [(masks & self.mask(indices)) != 0 for label, indices in buckets]
+        codes = np.select(conditions, np.arange(len(buckets)), default=len(buckets))
+        return pd.Categorical.from_codes(codes, [label for label, indices in buckets] + [default])
+
+    def aggregate(self, df: pd.DataFrame, masks: np.ndarray) -> pd.DataFrame:
+        '''
+        Sum every column of df over the constituents of each index. Indices may overlap, so the rows do not add up.
+        :param df: pd.DataFrame, numeric columns, one row per code in the order of masks
+        :param masks: np.ndarray of uint64, result of bitmask()
+        :return: pd.DataFrame, one row per index, labelled with INDEX_NAMES
+        '''
+        shifts = np.arange(len(self.indices), dtype=np.uint64)
+        membership = ((masks[:, None] >> shifts) & np.uint64(1)).astype(float)
+        totals = membership.T.dot(df.fillna(0).values)
+        return pd.DataFrame(totals, index=[INDEX_NAMES.get(index, index) for index in self.indices],
+                            columns=df.columns)
+
+
+class MarginLoanEngine(object):
+    '''
+    Day over day margin loan analysis. The engine keeps the margin data of the day it computed last,
+    so advancing to the next trading day costs one fetch of that day and one diff against the kept frame.
+    Jumping to any other date fetches the day before as well. Settled days come from the local cache,
+    so a restarted monitor does not query the day before again either.
+    '''
+
+    def __init__(self, include688=False, marginPanel=None, views=None):
+        '''
+        :param include688: bool, whether include stocks whose codes start with 688
+        :param marginPanel: pd.DataFrame, optional panel from getMarginLoanRange covering the dates to compute
+                            and the trading day before the first one
+        :param views: dict, ranking views put into the result, see rankViews, defaults to RANKING_VIEWS
+        '''
+        self.include688 = include688
+        self.marginPanel = marginPanel
+        self.views = RANKING_VIEWS if views is None else views
+        self.date = None  # day computed last
+        self.marginLoan = None  # its margin data, layout of getMarginLoan
+
+    def fetch(self, tradeDate: str) -> pd.DataFrame:
+        if self.marginPanel is None:
+            return getMarginLoan(tradeDate)
+        return selectMarginLoan(tradeDate, self.marginPanel)
+
+    def advance(self, date=None) -> dict:
+        '''
+        Compute the parameters of a date and keep its margin data for the next call
+        :param date: str, "yyyymmdd", None for the trading day after the one computed last,
+                     or for the last trading day up to today on the first call
+        :return: dict, dictionary of parameters, see calMarginLoanParam
+        '''
+        calendar = TradingCalendar.load()
+        if date is None:
+            date = time.strftime("%Y%m%d") if self.date is None else calendar.next(self.date)
+        date = calendar.resolve(date)
+        date_lag1 = calendar.prev(date)
+        # the queries are independent, run them concurrently on pooled sessions
+        with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+            # the day before is the one computed last time: reuse its frame instead of fetching it again
+            lagFuture = None if date_lag1 == self.date else executor.submit(self.fetch, date_lag1)
+            marginFuture = executor.submit(self.fetch, date)
+            grouping = IndexGrouping()
+            memberFuture = executor.submit(grouping.memberSets, date)
+            nameFuture = executor.submit(StockNames.load)
+            industryFuture = executor.submit(StockIndustries.load)
+            marginLoan_lag1 = self.marginLoan if lagFuture is None else lagFuture.result()
+            marginLoan = marginFuture.result()
+            memberSets = memberFuture.result()
+            stockNames = nameFuture.result()
+            stockIndustries = industryFuture.result()
+        print(date, date_lag1)
+        master = SecurityMaster.load()
+        self.date, self.marginLoan = date, marginLoan
+        marginLoan = pd.merge(marginLoan, marginLoan_lag1, left_index=True, right_index=True, how="left")
+        marginLoan = marginLoan[["endVol_y", "balance_y", "sell_x", "repay_x", "endVol_x", "balance_x"]]
+        marginLoan.columns = ["startVol", "startBalance", "sell", "repay", "endVol", "endBalance"]
+        # stocks missing on the lag date: rebuild the start from today's flows and value it at today's price.
+        # With endVol == 0 there is no price to value it, so its start balance is taken as 0.
+        missing = marginLoan.startVol.isnull().values
+        endVol, endBalance = marginLoan.endVol.values, marginLoan.endBalance.values
+        startVol = endVol + marginLoan.repay.values - marginLoan.sell.values
+        price = np.divide(endBalance, endVol, out=np.zeros(len(endVol)), where=endVol != 0)
+        marginLoan["startVol"] = np.where(missing, startVol, marginLoan.startVol.values)
+        marginLoan["startBalance"] = np.where(missing, price * startVol, marginLoan.startBalance.values)
+        marginLoan["change"] = marginLoan["endVol"].squeeze().sub(marginLoan["startVol"].squeeze())
+        marginLoan["change_balance"] = marginLoan["endBalance"].squeeze().sub(marginLoan["startBalance"].squeeze())
+        marginLoan["board"] = master.boards(marginLoan.index)
+        # board totals cover every stock, 688 included
+        marginBoard = marginLoan.groupby("board", observed=False)[["endBalance", "change_balance"]].sum()
+        marginBoard["balance_pct"] = marginBoard.endBalance / marginBoard.endBalance.sum() * 100
+        marginBoard = marginBoard[["endBalance", "balance_pct", "change_balance"]]
+        if self.include688 is False:
+            marginLoan = marginLoan[marginLoan["board"].values != "科创板"]
+        masks = grouping.bitmask(marginLoan.index, memberSets)
+        marginLoan["group"] = grouping.assign(masks, GROUP_BUCKETS, GROUP_DEFAULT)
+        marginIndex = grouping.aggregate(marginLoan[["endBalance", "change_balance"]], masks)
+        marginIndex["balance_pct"] = marginIndex.endBalance / marginLoan.endBalance.sum() * 100
+        marginIndex = marginIndex[["endBalance", "balance_pct", "change_balance"]]
+
+        marginLoan["industry"] = stockIndustries.lookup(marginLoan.index).values
+        # one groupby over both axes, the index bucket and the industry tables are its two marginals
+        marginBoth = marginLoan.groupby(["group", "industry"], observed=True)[["endBalance", "change_balance"]].sum()
+        marginIndustry = marginBoth.groupby(level="industry").sum().sort_values(by="endBalance", ascending=False)
+        marginIndustry["balance_pct"] = marginIndustry.endBalance / marginIndustry.endBalance.sum() * 100
+        marginIndustry = marginIndustry[["endBalance", "balance_pct", "change_balance"]]
+
+        marginGroup = marginBoth.groupby(level="group").sum().reindex(GROUP_ORDER, fill_value=0)
+        marginGroup["balance_pct"] = marginGroup.endBalance / marginGroup.endBalance.sum()
+        marginGroup = marginGroup[["endBalance", "balance_pct", "change_balance"]]
+        marginGroup.balance_pct *= 100
+        marginGroup.loc["sum"] = [marginGroup.endBalance.sum(), marginGroup.balance_pct.sum(), marginGroup.change_balance.sum()]
+
+        rankings = rankViews(marginLoan, self.views, stockNames, grouping, masks)
+
+        marginLoan["code"] = master.codes(marginLoan.index)
+
+        param_dict = {"size": marginGroup, "date": date, "688": round(marginBoard.loc["科创板", "endBalance"], 2),
+                      "main": round(marginBoard.loc[MAIN_BOARDS, "endBalance"].sum(), 2), "board": marginBoard,
+                      "index": marginIndex, "industry": marginIndustry}
+        param_dict.update(rankings)
+        dumpDebugFrame(date, marginLoan)
+        return param_dict
 
 
 class App(QWidget):
@@ -73,6 +1389,7 @@ class App(QWidget):
         self.date = param_dict["date"]
         self.marginGroup = param_dict["size"]
         self.marginSorted = param_dict["change"]
+        self.marginBottom = param_dict["changeBottom"]
         self.marginHS300 = param_dict["HS300"]
         self.marginCSI500 = param_dict["CSI500"]
         self.title = '转融通分析'
@@ -128,9 +1445,10 @@ class App(QWidget):
         self.groupTable.setRowHeight(1, 40)
         self.groupTable.setRowHeight(2, 40)
         self.groupTable.setRowHeight(3, 40)
+        marginGroup = dfItemToStr(self.marginGroup)
         for i in range(0, 4):
             for j in range(0, 3):
-                self.groupTable.setItem(i, j, QTableWidgetItem(self.marginGroup.iloc[i, j]))
+                self.groupTable.setItem(i, j, QTableWidgetItem(marginGroup.iloc[i, j]))
         self.groupTable.setHorizontalHeaderLabels(["金额（万元）", "百分比", "变化量（万元）"])
         self.groupTable.setVerticalHeaderLabels(["沪深300成分股", "中证500成分股", "其他股票", "合计"])
 
@@ -139,9 +1457,10 @@ class App(QWidget):
         self.sortTable.setRowCount(10)
         self.sortTable.setColumnCount(5)
         self.sortTable.setColumnWidth(3, 110)
+        marginSorted = dfItemToStr(self.marginSorted, rows=10)
         for i in range(0, 10):
             for j in range(0, 5):
-                self.sortTable.setItem(i, j, QTableWidgetItem(self.marginSorted.iloc[i, j]))
+                self.sortTable.setItem(i, j, QTableWidgetItem(marginSorted.iloc[i, j]))
         self.sortTable.setHorizontalHeaderLabels(["股票名称", "股票代码", "变化量(万元)", "期末余额（万元）", "分类"])
         self.sortTable.setVerticalHeaderLabels(["期末余额排名" + str(i) for i in range(1, 11)])
 
@@ -150,9 +1469,10 @@ class App(QWidget):
         self.sortTable2.setRowCount(10)
         self.sortTable2.setColumnCount(5)
         self.sortTable2.setColumnWidth(3, 110)
+        marginSorted = dfItemToStr(self.marginBottom, rows=10)
         for i in range(0, 10):
             for j in range(0, 5):
-                self.sortTable2.setItem(i, j, QTableWidgetItem(self.marginSorted.iloc[- i - 1, j]))
+                self.sortTable2.setItem(i, j, QTableWidgetItem(marginSorted.iloc[i, j]))
         self.sortTable2.setHorizontalHeaderLabels(["股票名称", "股票代码", "变化量(万股)", "期末余额（万股）", "分类"])
         self.sortTable2.setVerticalHeaderLabels(["期末余额排名" + str(i) for i in range(1, 11)])
 
@@ -161,9 +1481,10 @@ class App(QWidget):
         self.HS300Table.setRowCount(10)
         self.HS300Table.setColumnCount(5)
         self.HS300Table.setColumnWidth(3, 110)
+        marginHS300 = dfItemToStr(self.marginHS300, rows=10)
         for i in range(0, 10):
             for j in range(0, 5):
-                self.HS300Table.setItem(i, j, QTableWidgetItem(self.marginHS300.iloc[i, j]))
+                self.HS300Table.setItem(i, j, QTableWidgetItem(marginHS300.iloc[i, j]))
         self.HS300Table.setHorizontalHeaderLabels(["股票名称", "股票代码", "变化量(万元)", "期末余额（万元）", "分类"])
         self.HS300Table.setVerticalHeaderLabels(["期末余额排名" + str(i) for i in range(1, 11)])
 
@@ -172,9 +1493,10 @@ class App(QWidget):
         self.CSI500Table.setRowCount(10)
         self.CSI500Table.setColumnCount(5)
         self.CSI500Table.setColumnWidth(3, 110)
+        marginCSI500 = dfItemToStr(self.marginCSI500, rows=10)
         for i in range(0, 10):
             for j in range(0, 5):
-                self.CSI500Table.setItem(i, j, QTableWidgetItem(self.marginCSI500.iloc[i, j]))
+                self.CSI500Table.setItem(i, j, QTableWidgetItem(marginCSI500.iloc[i, j]))
         self.CSI500Table.setHorizontalHeaderLabels(["股票名称", "股票代码", "变化量(万元)", "期末余量（万元）", "分类"])
         self.CSI500Table.setVerticalHeaderLabels(["期末余量排名" + str(i) for i in range(1, 11)])
 
@@ -190,6 +1512,154 @@ class App(QWidget):
 
 
 
+def localCachePath(table: str, key: str) -> str:
+    '''
+    :param table: str, sub directory of the cache, e.g. "margin"
+    :param key: str, partition key, e.g. a trade date
+    :return: str, file path of the cached partition
+    '''
+    suffix = ".parquet" if CACHE_FORMAT == "parquet" else ".pkl"
+    return os.path.join(CACHE_DIR, table, key + suffix)
+
+
+def readLocalCache(table: str, key: str):
+    '''
+    Read one partition of the local cache.
+    :return: pd.DataFrame, or None if the partition is missing or unreadable
+    '''
+    path = localCachePath(table, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        if CACHE_FORMAT == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+    except Exception:
+        return None
+
+
+def writeLocalCache(table: str, key: str, df: pd.DataFrame) -> bool:
+    '''
+    Write one partition of the local cache. The file is replaced atomically so readers never see half a file.
+    :return: bool, whether the partition was written
+    '''
+    path = localCachePath(table, key)
+    tmpPath = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if CACHE_FORMAT == "parquet":
+            df.to_parquet(tmpPath)
+        else:
+            df.to_pickle(tmpPath)
+        os.replace(tmpPath, path)
+        return True
+    except Exception:
+        print("Failed on writing local cache " + path + "!")
+        return False
+
+
+def readSidCache(table: str, key: str):
+    '''
+    Read one partition keyed by sid. Partitions keep the windcode of every row, rows whose sid no longer
+    matches their windcode in the security master are re-keyed, partitions without windcodes are ignored.
+    :return: pd.DataFrame indexed by sid, or None if the partition is missing or unreadable
+    '''
+    df = readLocalCache(table, key)
+    if df is None or "windcode" not in df.columns:
+        return None
+    ids = SecurityMaster.load().ids(df.windcode.values)
+    if not np.array_equal(ids, df.index.values):
+        df.index = pd.Index(ids, name="sid")
+    return df.drop(columns="windcode")
+
+
+def writeSidCache(table: str, key: str, df: pd.DataFrame) -> bool:
+    '''
+    Write one partition keyed by sid together with the windcode of every row.
+    Nothing is written while the security master cannot be saved.
+    :return: bool, whether the partition was written
+    '''
+    master = SecurityMaster.load()
+    if not master.persisted:
+        return False
+    df = df.copy()
+    df["windcode"] = master.codes(df.index)
+    return writeLocalCache(table, key, df)
+
+
+_debugQueue = queue.Queue()
+_debugWriter = None
+_debugLock = threading.Lock()
+
+
+def _writeDebugFrames():
+    while True:
+        path, df = _debugQueue.get()
+        try:
+            tmpPath = path + ".tmp"
+            if CACHE_FORMAT == "parquet":
+                df.to_parquet(tmpPath)
+            else:
+                df.to_pickle(tmpPath)
+            os.replace(tmpPath, path)
+        except Exception:
+            print("Failed on writing debug snapshot " + path + "!")
+        finally:
+            _debugQueue.task_done()
+
+
+def dumpDebugFrame(date: str, df: pd.DataFrame):
+    '''
+    Queue a snapshot of df for DEBUG_DIR/<date>.parquet (.pkl without pyarrow), written by a background thread.
+    Does nothing when DEBUG_DIR is not set. Pending snapshots are flushed when the process exits.
+    :param date: str, "yyyymmdd"
+    :param df: pd.DataFrame, copied before it is queued
+    '''
+    global _debugWriter
+    if not DEBUG_DIR:
+        return
+    with _debugLock:
+        if _debugWriter is None:
+            os.makedirs(DEBUG_DIR, exist_ok=True)
+            _debugWriter = threading.Thread(target=_writeDebugFrames, name="debug-writer", daemon=True)
+            _debugWriter.start()
+            atexit.register(_debugQueue.join)
+    suffix = ".parquet" if CACHE_FORMAT == "parquet" else ".pkl"
+    _debugQueue.put((os.path.join(DEBUG_DIR, date + suffix), df.copy()))
+
+
+def inListBatches(codes, sizes=IN_LIST_SIZES):
+    '''
+    Split codes into IN lists of bind variables, each padded to one of sizes by repeating its last code
+    :param codes: list-like of str
+    :param sizes: list of int, ascending
+    :return: generator of (str, dict), the placeholders ":c0, :c1, ..." and their bind values
+    '''
+    codes = list(codes)
+    for i in range(0, len(codes), sizes[-1]):
+        batch = codes[i:i + sizes[-1]]
+        size = min(size for size in sizes if size >= len(batch))
+        batch = batch + batch[-1:] * (size - len(batch))
+        yield ", ".join(":c" + str(j) for j in range(size)), {"c" + str(j): code for j, code in enumerate(batch)}
+
+
+def isSettledDate(date: str) -> bool:
+    '''
+    Data of days before today is settled and will not change any more, so it is safe to cache.
+    :param date: str, "yyyymmdd"
+    '''
+    return date < time.strftime("%Y%m%d")
+
+
+def shiftDate(date: str, days: int) -> str:
+    '''
+    :param date: str, "yyyymmdd"
+    :param days: int, calendar days to add
+    :return: str, "yyyymmdd"
+    '''
+    return (pd.Timestamp(date) + pd.Timedelta(days=days)).strftime("%Y%m%d")
+
+
 def lowCaseDfColumns(df: pd.DataFrame) -> pd.DataFrame:
     '''
     :param df: pd.DataFrame
@@ -200,89 +1670,101 @@ def lowCaseDfColumns(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def dfItemToStr(df: pd.DataFrame) -> pd.DataFrame:
-    '''convert all numbers in a dataframe to str, rounded to 2 digits.'''
-    for label in df.index:
-        for col in df.columns:
-            if type(df.loc[label, col]) is float or type(df.loc[label, col]) is np.float64:
-                df.loc[label, col] = str(round(df.loc[label, col], 2))
+def dfItemToStr(df: pd.DataFrame, rows=None) -> pd.DataFrame:
+    '''
+    convert all float columns in a dataframe to str, rounded to 2 digits. The input is left numeric.
+    :param rows: int, only the first rows rows are converted and returned, None for all of them
+    '''
+    if rows is not None:
+        df = df.iloc[:rows]
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == np.float64:
+            df[col] = df[col].round(2).astype(str)
+        elif df[col].dtype.name == "category":
+            df[col] = df[col].astype(str)
     return df
 
 
-def calMarginLoanParam(date: str, include688=False) -> dict:
+def rankViews(marginLoan: pd.DataFrame, views: dict, stockNames, grouping=None, masks=None) -> dict:
+    '''
+    Rank all stocks by end balance once and cut every view of RANKING_VIEWS out of that ranking.
+    Names are looked up only for the rows that end up in a view. Stocks without a name are skipped
+    like in an inner merge, so a view takes more candidates until it has n named rows.
+    :param marginLoan: pd.DataFrame, indexed by sid, with the columns the views filter on
+    :param views: dict, view name -> dict with "n" (None for the whole view), optionally "bottom": True
+                  to rank from the smallest balance up, and optionally
+                  "column" and "value" to keep the rows where column == value,
+                  "column" alone for one ranking per value of the column,
+                  or "index" to keep the constituents of an index of GROUP_INDICES
+    :param stockNames: StockNames
+    :param grouping: IndexGrouping, needed by "index" views
+    :param masks: np.ndarray of uint64, bitmask of every row of marginLoan, needed by "index" views
+    :return: dict, view name -> pd.DataFrame indexed by code, columns ["stockName", "code", "change_balance", "endBalance", "group"],
+             or a dict value -> pd.DataFrame for views split by a column
+    '''
+    master = SecurityMaster.load()
+    order = np.argsort(-marginLoan.endBalance.values, kind="stable")
+    ranked = marginLoan.iloc[order]
+
+    # positions in ranked of the rows of every (view, value), in rank order
+    slices = {}
+    for name, view in views.items():
+        if "index" in view:
+            keep = (masks[order] & grouping.mask([view["index"]])) != 0
+            slices[(name, None)] = np.flatnonzero(keep)
+        elif "value" in view:
+            slices[(name, None)] = np.flatnonzero(ranked[view["column"]].values == view["value"])
+        elif "column" in view:
+            for value, positions in ranked.groupby(view["column"], sort=False, observed=True).indices.items():
+                slices[(name, value)] = positions
+        else:
+            slices[(name, None)] = np.arange(len(ranked))
+    for (name, value), positions in slices.items():
+        if views[name].get("bottom"):
+            slices[(name, value)] = positions[::-1]
+
+    limits = {key: len(positions) if views[key[0]].get("n") is None else views[key[0]]["n"]
+              for key, positions in slices.items()}
+    while True:
+        candidates = np.unique(np.concatenate([positions[:limits[key]] for key, positions in slices.items()] + [[]])).astype(int)
+        names = stockNames.frame(ranked.index[candidates]).stockName
+        named = ranked.index.isin(names.index)
+        short = [key for key, positions in slices.items()
+                 if named[positions[:limits[key]]].sum() < limits[key] and limits[key] < len(positions)]
+        if len(short) == 0:
+            break
+        for key in short:
+            limits[key] *= 2
+
+    selected = {key: positions[:limits[key]][named[positions[:limits[key]]]][:views[key[0]].get("n")]
+                for key, positions in slices.items()}
+    rows = np.unique(np.concatenate(list(selected.values()) + [[]])).astype(int)
+    table = ranked.iloc[rows][["change_balance", "endBalance", "group"]]
+    table.insert(0, "stockName", names.reindex(table.index).values)
+    table.index = master.codes(table.index)
+    table.insert(1, "code", table.index)
+
+    result = {}
+    for (name, value), positions in selected.items():
+        frame = table.iloc[np.searchsorted(rows, positions)]
+        if value is None:
+            result[name] = frame
+        else:
+            result.setdefault(name, {})[value] = frame
+    return result
+
+
+def calMarginLoanParam(date: str, include688=False, marginPanel=None, views=None) -> dict:
     '''
-    Get a df of Margin Finance Loans
+    Get a df of Margin Finance Loans. Use a MarginLoanEngine to compute consecutive days.
     :param date: str, "yyyymmdd"
     :Include688: bool, whether include stocks whose codes start with 688
+    :param marginPanel: pd.DataFrame, optional panel from getMarginLoanRange covering date and its previous trading day
+    :param views: dict, ranking views put into the result, see rankViews, defaults to RANKING_VIEWS
     :return: dict, dictionary of parameters
     '''
-    tradingDay_list = getTradingDays("20120101", "20191231")
-    date_lag1 = tradingDay_list[tradingDay_list.index(date) - 1]
-    print(date, date_lag1)
-    marginLoan = getMarginLoan(date)
-    marginLoan_lag1 = getMarginLoan(date_lag1)
-    marginLoan = pd.merge(marginLoan, marginLoan_lag1, left_index=True, right_index=True, how="left")
-    marginLoan = marginLoan[["endVol_y", "balance_y", "sell_x", "repay_x", "endVol_x", "balance_x"]]
-    marginLoan.columns = ["startVol", "startBalance", "sell", "repay", "endVol", "endBalance"]
-    for label in marginLoan.index:
-        if np.isnan(marginLoan.loc[label, "startVol"]):
-            marginLoan.loc[label, "startVol"] = marginLoan.loc[label, "endVol"] + marginLoan.loc[label, "repay"] - \
-                                                marginLoan.loc[label, "sell"]
-            marginLoan.loc[label, "startBalance"] = marginLoan.loc[label, "endBalance"] / marginLoan.loc[
-                label, "endVol"] * marginLoan.loc[label, "startVol"]
-    marginLoan["change"] = marginLoan["endVol"].squeeze().sub(marginLoan["startVol"].squeeze())
-    marginLoan["change_balance"] = marginLoan["endBalance"].squeeze().sub(marginLoan["startBalance"].squeeze())
-    if include688 is False:
-        no688_list = [not a.startswith("688") for a in marginLoan.index]
-        true_688_list = [a.startswith("688") for a in marginLoan.index]
-        loan688 = marginLoan.loc[true_688_list, :]
-        marginLoan = marginLoan.loc[no688_list, :]
-    HS_list = getIndexConstituent(date, index="HS")
-    CSI_list = getIndexConstituent(date, index="CSI")
-    marginLoan["group"] = "其他股票"
-    for label in marginLoan.index:
-        if label in HS_list:
-            marginLoan.loc[label, "group"] = "沪深300"  # "HS"
-        if label in CSI_list:
-            marginLoan.loc[label, "group"] = "中证500"  # "CSI"
-    stockName_df = getStockName()
-
-    marginGroup = marginLoan.groupby("group").sum()
-    marginGroup["balance_pct"] = marginGroup.endBalance / marginGroup.endBalance.sum()
-    marginGroup = marginGroup[["endBalance", "balance_pct", "change_balance"]]
-    marginGroup.balance_pct *= 100
-    marginGroup.loc["sum"] = [marginGroup.endBalance.sum(), marginGroup.balance_pct.sum(), marginGroup.change_balance.sum()]
-    marginGroup = dfItemToStr(marginGroup)
-    marginGroup = marginGroup.iloc[[2, 0, 1, 3], :]
-
-    marginSorted = marginLoan.sort_values(by="endBalance", ascending=False)
-    marginSorted = marginSorted[["endBalance", "change_balance", "group"]]
-    marginSorted = pd.merge(marginSorted, stockName_df, left_index=True, right_index=True)
-    marginSorted["code"] = marginSorted.index
-    marginSorted.columns = ["endBalance", "change_balance", "group", "stockName", "code"]
-    marginSorted = marginSorted[["stockName", "code", "change_balance", "endBalance", "group"]]
-    marginSorted = dfItemToStr(marginSorted)
-
-    marginHS300 = marginLoan[marginLoan["group"] == "沪深300"].sort_values(by="endBalance", ascending=False)
-    marginHS300 = marginHS300[["endBalance", "change_balance", "group"]]
-    marginHS300 = pd.merge(marginHS300, stockName_df, left_index=True, right_index=True)
-    marginHS300["code"] = marginHS300.index
-    marginHS300.columns = ["endBalance", "change_balance", "group", "stockName", "code"]
-    marginHS300 = marginHS300[["stockName", "code", "change_balance", "endBalance", "group"]]
-    marginHS300 = dfItemToStr(marginHS300)
-
-    marginCSI500 = marginLoan[marginLoan["group"] == "中证500"].sort_values(by="endBalance", ascending=False)
-    marginCSI500 = marginCSI500[["endBalance", "change_balance", "group"]]
-    marginCSI500 = pd.merge(marginCSI500, stockName_df, left_index=True, right_index=True)
-    marginCSI500["code"] = marginCSI500.index
-    marginCSI500.columns = ["endBalance", "change_balance", "group", "stockName", "code"]
-    marginCSI500 = marginCSI500[["stockName", "code", "change_balance", "endBalance", "group"]]
-    marginCSI500 = dfItemToStr(marginCSI500)
-
-    param_dict = {"size": marginGroup, "change": marginSorted, "date": date, "688": loan688.endBalance.sum(),
-                  "HS300": marginHS300, "CSI500": marginCSI500}
-    marginLoan.to_csv("debug.csv")
-    return param_dict
+    return MarginLoanEngine(include688, marginPanel, views).advance(date)
 
 
 def getTradingDays(startDate: str, endDate: str) -> list:
@@ -295,10 +1777,10 @@ def getTradingDays(startDate: str, endDate: str) -> list:
         asharecalendar 
     WHERE
         S_INFO_EXCHMARKET = 'SSE' 
-        AND trade_days BETWEEN {} AND {}
-    '''.format(startDate, endDate)
+        AND trade_days BETWEEN :startDate AND :endDate
+    '''
     with OracleSql() as oracle:
-        tradingDays = oracle.query(sql)
+        tradingDays = oracle.query(sql, {"startDate": startDate, "endDate": endDate}, fallback=False)
     return list(tradingDays.TRADE_DAYS)
 
 
@@ -310,9 +1792,14 @@ def getMarginLoan(date: str) -> pd.DataFrame:
     Besides, the open price and close price of individual stocks is different. So it is hard to calculate the start balance in this way.
     Therefore, in function "getMarginLoanParam", a more accurate way is to replace the startVol with the previous day's endVol and use the previous balance as the start balance.
 
+    Settled days are read from the local cache and only missing days are queried from the database.
+
     :param date: str, "yyyymmdd"
     :return: pd.DataFrame
     '''
+    marginData = readSidCache("margin_sid", date)
+    if marginData is not None:
+        return marginData
 
     sql = \
         '''
@@ -323,64 +1810,149 @@ def getMarginLoan(date: str) -> pd.DataFrame:
     FROM 
         AShareMarginTrade
     WHERE
-        TRADE_DT = {}
+        TRADE_DT = :tradeDate
         AND S_REFIN_SL_EOP_VOL IS NOT NULL
     ORDER BY
         S_INFO_WINDCODE
-    '''.format(date)
+    '''
 
-    with OracleSql() as oracle:
-        marginData = oracle.query(sql)
+    try:
+        with OracleSql() as oracle:
+            marginData = oracle.query(sql, {"tradeDate": date}, fallback=False)
+    except DatabaseUnavailableError as e:
+        return getOfflineMarginLoan(date, e)
     marginData = lowCaseDfColumns(marginData)
     marginData.fillna(0, inplace=True)
     if len(marginData) == 0:
         print("No Oracle data available on " + date + "!!!\nUse web data instead!")
         return mannuallyGetMarginLoan(date)
-    marginData.set_index("s_info_windcode", inplace=True)
-    marginData.columns = ["trade_dt", "sell", "endVol", "balance", "repay"]
-    marginData.endVol /= 10000
-    marginData.sell /= 10000
-    marginData.repay /= 10000
-    marginData.balance /= 10000
+    marginData["sid"] = SecurityMaster.load().ids(marginData.s_info_windcode)
+    marginData.set_index("sid", inplace=True)
+    marginData = convertMarginData(marginData)
+    if isSettledDate(date):
+        writeSidCache("margin_sid", date, marginData)
+    return marginData
+
+
+def getMarginLoanRange(startDate: str, endDate: str) -> pd.DataFrame:
+    '''
+    Get daily margin finance loan data of every trading day between startDate and endDate in one query.
+    The unit conversions are the same as getMarginLoan.
+    :param startDate: str, "yyyymmdd"
+    :param endDate: str, "yyyymmdd"
+    :return: pd.DataFrame, indexed by (trade_dt, sid)
+    '''
+    sql = \
+        '''
+        SELECT
+        ''' + '''
+        S_INFO_WINDCODE, TRADE_DT, S_REFIN_SB_EOD_VOL, S_REFIN_SL_EOP_VOL,
+        S_REFIN_SL_EOP_BAL, S_REFIN_REPAY_VOL
+    FROM
+        AShareMarginTrade
+    WHERE
+        TRADE_DT BETWEEN :startDate AND :endDate
+        AND S_REFIN_SL_EOP_VOL IS NOT NULL
+    ORDER BY
+        TRADE_DT, S_INFO_WINDCODE
+    '''
+
+    try:
+        with OracleSql() as oracle:
+            chunks = list(oracle.query_iter(sql, {"startDate": startDate, "endDate": endDate}))
+    except DatabaseUnavailableError as e:
+        # an empty panel makes selectMarginLoan read every day through getMarginLoan and its cache
+        print("Margin data of " + startDate + "-" + endDate + " is read day by day: " + str(e))
+        chunks = []
+    if len(chunks) == 0:
+        marginPanel = pd.DataFrame(columns=["S_INFO_WINDCODE", "TRADE_DT", "S_REFIN_SB_EOD_VOL", "S_REFIN_SL_EOP_VOL",
+                                            "S_REFIN_SL_EOP_BAL", "S_REFIN_REPAY_VOL"])
+    else:
+        marginPanel = pd.concat(chunks, ignore_index=True)
+    marginPanel = lowCaseDfColumns(marginPanel)
+    marginPanel.fillna(0, inplace=True)
+    marginPanel["sid"] = SecurityMaster.load().ids(marginPanel.s_info_windcode)
+    marginPanel.set_index(["trade_dt", "sid"], inplace=True)
+    return convertMarginData(marginPanel)
+
+
+def getOfflineMarginLoan(date: str, error) -> pd.DataFrame:
+    '''
+    Margin data of a day that is not cached while the database is unavailable: the manually pasted
+    excel file of the day if there is one, otherwise the latest cached day before it
+    :param date: str, "yyyymmdd"
+    :param error: the error that made the database unavailable
+    :return: pd.DataFrame, same layout as getMarginLoan
+    '''
+    if os.path.exists(date + ".xlsx"):
+        print("Database unavailable, using " + date + ".xlsx! " + str(error))
+        return mannuallyGetMarginLoan(date)
+    directory = os.path.dirname(localCachePath("margin_sid", date))
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    days = sorted(name[:8] for name in names if name[:8].isdigit() and name[:8] < date and not name.endswith(".tmp"))
+    for day in reversed(days):
+        marginData = readSidCache("margin_sid", day)
+        if marginData is not None:
+            print("Database unavailable, using the margin data of " + day + " for " + date + "! " + str(error))
+            return marginData
+    raise DatabaseUnavailableError("No margin data for " + date + ": " + str(error))
+
+
+def selectMarginLoan(date: str, marginPanel: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Take one day out of a panel built by getMarginLoanRange.
+    Dates missing from the panel fall back to getMarginLoan.
+    :param date: str, "yyyymmdd"
+    :param marginPanel: pd.DataFrame, indexed by (trade_dt, sid)
+    :return: pd.DataFrame, same layout as getMarginLoan
+    '''
+    if date not in marginPanel.index.get_level_values(0):
+        return getMarginLoan(date)
+    return marginPanel.xs(date, level=0)
+
+
+def convertMarginData(marginData: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Rename the raw AShareMarginTrade columns and convert volumes and balances to 万股/万元.
+    :param marginData: pd.DataFrame, raw lower-cased query result indexed by sid (and date)
+    :return: pd.DataFrame, columns ["startVol", "sell", "repay", "endVol", "balance"]
+    '''
+    marginData = marginData[["s_refin_sb_eod_vol", "s_refin_sl_eop_vol", "s_refin_sl_eop_bal", "s_refin_repay_vol"]]
+    marginData.columns = ["sell", "endVol", "balance", "repay"]
+    marginData = marginData.astype(float) / 10000
     marginData["startVol"] = marginData.endVol + marginData.repay - marginData.sell
     marginData = marginData[["startVol", "sell", "repay", "endVol", "balance"]]
     return marginData
 
 
-def getIndexConstituent(date: str, index: str) -> list:
+def getStockIndustry(codes=None) -> pd.Series:
+    '''
+    Current Shenwan level 1 industry of every stock
+    :param codes: list-like of windcodes, None for all stocks
+    :return: pd.Series, industry names indexed by windcode
+    '''
+    sql = \
+        '''
+        SELECT
+        ''' + '''
+        a.S_INFO_WINDCODE, b.INDUSTRIESNAME
+    FROM
+        AShareSWIndustriesClass a, AShareIndustriesCode b
+    WHERE
+        SUBSTR(a.SW_IND_CODE, 1, 4) = SUBSTR(b.INDUSTRIESCODE, 1, 4)
+        AND b.LEVELNUM = '2'
+        AND a.CUR_SIGN = '1'
     '''
-    get CSI 500 constituent stocks' code list
-    :param date: str, "yyyymmdd"
-    :param index: str, "SH" for 沪深300 and "CSI" for 中证500
-    :return: list
-    '''
-    if index == "CSI":
-        sql = \
-            '''
-               SELECT
-               ''' + '''
-                    *
-               FROM
-                    aindexcsi500weight
-               WHERE
-                    TRADE_DT = {}
-            '''.format(date)
-    elif index == "HS":
-        sql = \
-            '''
-               SELECT
-               ''' + '''
-                    *
-               FROM
-                    AIndexHS300Weight
-               WHERE
-                    TRADE_DT = {}
-            '''.format(date)
-    else:
-        raise ValueError("Parameter Error!")
     with OracleSql() as oracle:
-        SCI500WeightData = oracle.query(sql)
-    return list(SCI500WeightData.S_CON_WINDCODE)
+        if codes is None:
+            industry_df = oracle.query(sql, fallback=False)
+        else:
+            industry_df = pd.concat([oracle.query(sql + "    AND a.S_INFO_WINDCODE IN ({})\n".format(placeholders),
+                                                  params, fallback=False)
+                                     for placeholders, params in inListBatches(codes)], ignore_index=True)
+    industry_df.columns = ["S_INFO_WINDCODE", "industry"]
+    industry_df = industry_df.drop_duplicates("S_INFO_WINDCODE")
+    return industry_df.set_index("S_INFO_WINDCODE").industry
 
 
 def getStockName() -> pd.DataFrame:
@@ -393,7 +1965,7 @@ def getStockName() -> pd.DataFrame:
     AShareDescription
     '''
     with OracleSql() as oracle:
-        stockName_df = oracle.query(sql)
+        stockName_df = oracle.query(sql, fallback=False)
     stockName_df.set_index("S_INFO_WINDCODE", inplace=True)
     return stockName_df
 
@@ -410,23 +1982,20 @@ def mannuallyGetMarginLoan(date) -> pd.DataFrame:
     marginLoan.replace('-', 0, inplace=True)
     marginLoan.columns = ["code_short", "startVol", "sell", "endVol", "balance"]
     marginLoan.code_short = ['0' * (6 - len(str(code))) + code for code in list(marginLoan.code_short)]
-    NameAndCode = getStockName()
-    NameAndCode["S_INFO_WINDCODE"] = NameAndCode.index
-    NameAndCode["code_short"] = NameAndCode["S_INFO_WINDCODE"].apply(first6Letters)
-    NameAndCode.columns = ["stockName", "S_INFO_WINDCODE", "code_short"]
-    marginLoan = pd.merge(marginLoan, NameAndCode, on="code_short")
-    marginLoan.set_index("S_INFO_WINDCODE", inplace=True)
+    stockNames = StockNames.load()
+    marginLoan["sid"] = marginLoan.code_short.map(SecurityMaster.load().shortCodeIds())
+    marginLoan = marginLoan.dropna(subset=["sid"])
+    marginLoan = marginLoan.astype({"sid": np.int32}).set_index("sid")
+    marginLoan = marginLoan.join(stockNames.frame(marginLoan.index), how="inner")
     marginLoan["repay"] = marginLoan.endVol - marginLoan.endVol
 
     return marginLoan
 
 
-def first6Letters(s: str) -> str:
-    return s[:6]
-
-
 if __name__ == '__main__':
-    param_dict = calMarginLoanParam("20190904")
+    engine = MarginLoanEngine()
+    param_dict = engine.advance("20190904")
+    QueryStats.dump()
     app = QApplication(sys.argv)
     myTable = App(param_dict)
     myTable.show()